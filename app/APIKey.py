@@ -1,12 +1,13 @@
 import secrets
 import string
+import functools
 import hmac
 import hashlib
-import json
 import os
+import orjson
 import platform
 from datetime import datetime, timedelta, UTC
-from enum import Enum, Flag, auto
+from enum import Enum, IntFlag, auto
 from typing import Optional, List, Dict, Union, Set
 
 
@@ -45,8 +46,8 @@ class FileLock:
 
 
 # ===================== 权限枚举（显式指定数值，避免auto()兼容问题）=====================
-class APIPermission(Flag):
-    """APIKey 权限枚举（显式指定整数值，解决转换兼容问题）"""
+class APIPermission(IntFlag):
+    """APIKey 权限枚举（IntFlag 实例即整数，位运算与比较走 int 快速路径）"""
 
     NONE = 0  # 无权限
     READ = 1  # 只读（显式赋值1）
@@ -85,6 +86,7 @@ class APIKeyManager:
         use_safe_chars: bool = True,
         include_symbols: bool = False,
         persist_file: str = "./apikey_store.m5",
+        compact_threshold: int = 1000,
     ):
         self.salt = salt
         self.default_length = default_length
@@ -92,7 +94,21 @@ class APIKeyManager:
         self.use_safe_chars = use_safe_chars
         self.include_symbols = include_symbols
         self.persist_file = persist_file
+        # 变更以追加日志记录，累计 compact_threshold 条后合并为完整快照
+        self.journal_file = f"{persist_file}.log"
+        self.compact_threshold = compact_threshold
+        self._journal_entries = 0
+        # HMAC 结果按 APIKey 做有界 LRU 缓存，热点 Key 校验只需一次字典查找
+        self._hash_apikey = functools.lru_cache(maxsize=4096)(self._hash_apikey)
+        # 字符集与盐值字节在实例生命周期内不变，初始化时计算一次
+        self._charset = self._get_charset()
+        self._charset_table, self._reject_bytes = self._build_charset_table()
+        self._salt_bytes = salt.encode("utf-8")
+        self._journal_corrupted = False
         self.apikey_store: Dict[str, Dict] = self._load_from_file()
+        if self._journal_corrupted:
+            # 残缺行留在日志中会与后续追加的记录粘连，立即合并快照并清空日志
+            self._save_to_file()
 
     def _get_charset(self) -> str:
         letters = string.ascii_letters
@@ -112,22 +128,30 @@ class APIKeyManager:
             raise ValueError("字符集不能为空")
         return charset
 
+    def _build_charset_table(self):
+        """构造随机字节 -> 字符集的 translate 映射表及需丢弃的字节
+
+        256 不能被字符集长度整除时，丢弃 >= 256 - 256 % n 的字节（拒绝采样），
+        保证每个字符出现概率一致
+        """
+        charset_bytes = self._charset.encode("ascii")
+        charset_len = len(charset_bytes)
+        limit = 256 - 256 % charset_len
+        table = bytes(charset_bytes[b % charset_len] for b in range(256))
+        return table, bytes(range(limit, 256))
+
     def _hash_apikey(self, apikey: str) -> str:
         return hmac.new(
-            self.salt.encode("utf-8"), apikey.encode("utf-8"), hashlib.sha256
+            self._salt_bytes, apikey.encode("utf-8"), hashlib.sha256
         ).hexdigest()
 
     def _serialize_value(self, value):
         """
-        核心修复：改用枚举的 _value_ 属性获取整数值
+        APIPermission 为 IntFlag，按整数直接序列化
+        datetime 由 orjson 原生序列化为 ISO 8601，无需转换
         """
         try:
-            if isinstance(value, datetime):
-                return value.isoformat()
-            # 终极修复：Flag枚举用 _value_ 属性取整数值（兼容所有Python版本）
-            elif isinstance(value, APIPermission):
-                return value._value_  # 代替int(value)，这是枚举的标准取值方式
-            elif isinstance(value, (int, float, str, bool, type(None))):
+            if isinstance(value, (int, float, str, bool, datetime, type(None))):
                 return value
             else:
                 return str(value)
@@ -144,30 +168,34 @@ class APIKeyManager:
                     dt = dt.replace(tzinfo=UTC)
                 return dt
             elif key == "permissions" and value is not None:
-                # 兼容整数/字符串，转成int后再实例化枚举
-                val_int = int(value) if isinstance(value, str) else value
-                return APIPermission(val_int)
+                # 兼容整数/字符串，内存中统一保存为整数
+                return int(value)
             else:
                 return value
         except Exception as e:
             raise RuntimeError(f"反序列化失败（键：{key}，值：{value}）：{str(e)}")
 
+    def _serialize_meta(self, meta: Dict) -> Dict:
+        return {k: self._serialize_value(v) for k, v in meta.items()}
+
+    def _deserialize_meta(self, meta: Dict) -> Dict:
+        return {k: self._deserialize_value(k, v) for k, v in meta.items()}
+
     def _load_from_file(self) -> Dict[str, Dict]:
-        if not os.path.exists(self.persist_file):
-            return {}
+        apikey_store = {}
         try:
-            with FileLock(self.persist_file):
-                with open(self.persist_file, "r", encoding="utf-8") as f:
-                    raw_data = json.load(f)
-            apikey_store = {}
-            for hashed_key, meta in raw_data.items():
-                deserialized_meta = {}
-                for k, v in meta.items():
-                    deserialized_meta[k] = self._deserialize_value(k, v)
-                apikey_store[hashed_key] = deserialized_meta
+            if os.path.exists(self.persist_file):
+                with FileLock(self.persist_file):
+                    with open(self.persist_file, "rb") as f:
+                        content = f.read()
+                # 仅有文件锁创建的空文件时视为空快照
+                raw_data = orjson.loads(content) if content.strip() else {}
+                for hashed_key, meta in raw_data.items():
+                    apikey_store[hashed_key] = self._deserialize_meta(meta)
+            self._replay_journal(apikey_store)
             print(f"✅ 从 {self.persist_file} 加载 {len(apikey_store)} 条记录")
             return apikey_store
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             print(f"⚠️ {self.persist_file} 格式错误，初始化空存储")
             return {}
         except PermissionError:
@@ -175,20 +203,67 @@ class APIKeyManager:
         except Exception as e:
             raise RuntimeError(f"❌ 加载失败：{str(e)}")
 
+    def _replay_journal(self, apikey_store: Dict[str, Dict]):
+        """在快照之上按顺序重放追加日志"""
+        if not os.path.exists(self.journal_file):
+            return
+        with FileLock(self.persist_file):
+            with open(self.journal_file, "rb") as f:
+                lines = f.readlines()
+        for line in lines:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # 写入中断导致的残缺行跳过，加载完成后重写快照清除
+                print(f"⚠️ {self.journal_file} 存在残缺记录，已跳过")
+                self._journal_corrupted = True
+                continue
+            if entry["op"] == "put":
+                apikey_store[entry["key"]] = self._deserialize_meta(entry["meta"])
+            elif entry["op"] == "delete":
+                apikey_store.pop(entry["key"], None)
+            self._journal_entries += 1
+
+    def _append_journal(self, op: str, hashed_key: str):
+        """追加一条变更记录，仅序列化被修改的那条 APIKey"""
+        try:
+            entry = {"op": op, "key": hashed_key}
+            if op == "put":
+                entry["meta"] = self._serialize_meta(self.apikey_store[hashed_key])
+            line = orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE)
+
+            with FileLock(self.persist_file):
+                with open(self.journal_file, "a+b") as f:
+                    # 上次写入中断未以换行结尾时先补换行，避免本条记录与残缺行粘连
+                    if f.tell() > 0:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            line = b"\n" + line
+                    f.write(line)
+        except PermissionError:
+            raise PermissionError(f"❌ 无权限写入 {self.journal_file}")
+        except Exception as e:
+            raise RuntimeError(f"❌ 保存失败：{str(e)}")
+
+        self._journal_entries += 1
+        if self._journal_entries >= self.compact_threshold:
+            self._save_to_file()
+
     def _save_to_file(self):
+        """写入完整快照并清空追加日志"""
         try:
             serialized_data = {}
             for hashed_key, meta in self.apikey_store.items():
-                serialized_meta = {}
-                for k, v in meta.items():
-                    serialized_meta[k] = self._serialize_value(v)
-                serialized_data[hashed_key] = serialized_meta
+                serialized_data[hashed_key] = self._serialize_meta(meta)
 
             with FileLock(self.persist_file):
                 temp_file = f"{self.persist_file}.tmp"
-                with open(temp_file, "w", encoding="utf-8") as f:
-                    json.dump(serialized_data, f, indent=2, ensure_ascii=False)
+                with open(temp_file, "wb") as f:
+                    f.write(orjson.dumps(serialized_data, option=orjson.OPT_INDENT_2))
                 os.replace(temp_file, self.persist_file)
+                # 快照已包含全部变更，日志可清空（重放是幂等的，中途失败也不会出错）
+                open(self.journal_file, "w").close()
+            self._journal_entries = 0
         except PermissionError:
             raise PermissionError(f"❌ 无权限写入 {self.persist_file}")
         except Exception as e:
@@ -227,8 +302,13 @@ class APIKeyManager:
             raise TypeError("expire_at仅支持datetime/timedelta/None")
 
         # 生成APIKey
-        charset = self._get_charset()
-        random_part = "".join(secrets.choice(charset) for _ in range(length))
+        # 一次取两倍长度的随机字节，由 bytes.translate 在C层完成丢弃与映射
+        random_bytes = b""
+        while len(random_bytes) < length:
+            random_bytes += secrets.token_bytes(length * 2).translate(
+                self._charset_table, self._reject_bytes
+            )
+        random_part = random_bytes[:length].decode("ascii")
         raw_apikey = f"{prefix}{random_part}" if prefix else random_part
 
         # 存储元信息
@@ -236,12 +316,12 @@ class APIKeyManager:
         self.apikey_store[hashed_apikey] = {
             "raw_apikey": raw_apikey,
             "expire_at": expire_at,
-            "permissions": permissions,
+            "permissions": permissions._value_,  # 内存中以整数保存，校验时直接位运算
             "created_at": now,
             "user_id": user_id,
             "is_active": True,
         }
-        self._save_to_file()
+        self._append_journal("put", hashed_apikey)
         return raw_apikey
 
     def validate_apikey(
@@ -278,15 +358,14 @@ class APIKeyManager:
         # 检查权限
         has_perm = True
         if required_permissions:
-            has_perm = (
-                meta["permissions"] & required_permissions
-            ) == required_permissions
+            required = required_permissions._value_
+            has_perm = (meta["permissions"] & required) == required
             if not has_perm:
                 return {
                     "is_valid": True,
                     "is_expired": False,
                     "has_permission": False,
-                    "message": f"权限不足（当前：{meta['permissions']}，需要：{required_permissions}）",
+                    "message": f"权限不足（当前：{APIPermission(meta['permissions']).name}，需要：{required_permissions.name}）",
                 }
 
         return {
@@ -294,7 +373,7 @@ class APIKeyManager:
             "is_expired": False,
             "has_permission": has_perm,
             "message": "校验通过",
-            "permissions": meta["permissions"],
+            "permissions": APIPermission(meta["permissions"]),
             "expire_at": meta["expire_at"],
             "created_at": meta["created_at"],
             "user_id": meta["user_id"],
@@ -305,7 +384,7 @@ class APIKeyManager:
         if hashed not in self.apikey_store:
             return False
         self.apikey_store[hashed]["is_active"] = False
-        self._save_to_file()
+        self._append_journal("put", hashed)
         return True
 
     def delete_apikey(self, raw_apikey: str) -> bool:
@@ -313,11 +392,14 @@ class APIKeyManager:
         if hashed not in self.apikey_store:
             return False
         del self.apikey_store[hashed]
-        self._save_to_file()
+        self._append_journal("delete", hashed)
         return True
 
     def get_apikey_meta(self, raw_apikey: str) -> Optional[Dict]:
-        return self.apikey_store.get(self._hash_apikey(raw_apikey))
+        meta = self.apikey_store.get(self._hash_apikey(raw_apikey))
+        if meta is None:
+            return None
+        return {**meta, "permissions": APIPermission(meta["permissions"])}
 
 
 # ===================== 测试 =====================
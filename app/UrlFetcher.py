@@ -1,13 +1,117 @@
+import asyncio
+import codecs
+import functools
+import httpx
 import logging
+import lxml.html
 import re
 import requests
 import time
-from bs4 import BeautifulSoup
+from cachetools import TTLCache
+from charset_normalizer import from_bytes
+from contextlib import asynccontextmanager
+from lxml import etree
+from lxml.cssselect import CSSSelector
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+PLAYWRIGHT_WS_ENDPOINT = "ws://localhost:38291/e23e18f9f7deb171b72e32294f701368"
+# 连接浏览器服务的超时（毫秒），及共享连接失败后的重试冷却时间（秒）
+BROWSER_CONNECT_TIMEOUT = 10000
+BROWSER_RETRY_INTERVAL = 5
+# 静态页面响应体上限，超出直接放弃，避免超大页面占满内存
+MAX_CONTENT_LENGTH = 10 * 1024 * 1024
+
+# 带编码声明的文档（如XHTML）无法以str解析，回退为UTF-8字节解析
+_UTF8_HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+# 响应头未声明编码时，从文档开头的<meta charset>/<meta http-equiv>中探测
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([\w.:-]+)""", re.I)
+_META_SNIFF_BYTES = 4096
+# 与浏览器一致，将常见的窄字符集按其超集解码
+_ENCODING_SUPERSETS = {"gb2312": "gb18030", "gbk": "gb18030", "iso8859-1": "cp1252"}
+
+
+def _lookup_encoding(encoding):
+    """返回编码的规范名称，为空或无法识别时返回None"""
+    if not encoding:
+        return None
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return None
+
+
+def _build_session():
+    """创建带连接池与重试的共享Session，复用TCP/TLS连接"""
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=64,
+        pool_maxsize=64,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_selector(css_selector):
+    """将CSS选择器编译为XPath并缓存，重复的选择器无需再次解析"""
+
+    return CSSSelector(css_selector, translator="html")
+
+
+def _cache_entry_size(entry):
+    """缓存项按所持HTML的字符数计量，使缓存上限约束的是内存而非条目数"""
+
+    result = entry["result"]
+    return len(result["raw_html"]) + len(result.get("normalized_html") or "")
+
+
+def build_async_client():
+    """创建共享的httpx.AsyncClient，由应用生命周期统一创建与关闭"""
+
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=128, max_keepalive_connections=64),
+        timeout=30,
+        follow_redirects=True,
+        headers={"User-Agent": USER_AGENT},
+    )
 
 
 class UrlFetcher:
-    def __init__(self):
+    _SESSION = _build_session()
+
+    def __init__(
+        self,
+        max_per_host=64,
+        max_pages=8,
+        cache_max_bytes=256 * 1024 * 1024,
+        cache_ttl=600,
+    ):
         self.logger = self._setup_logging()
+        # 按域名限制并发，避免单站点被打满；域名 -> [信号量, 持有及等待数]
+        self._max_per_host = max_per_host
+        self._host_slots = {}
+        # 限制共享浏览器中同时打开的页面数
+        self._page_slots = asyncio.BoundedSemaphore(max_pages)
+        # 共享浏览器连接及上下文，由应用生命周期启动，断开后在锁内重连
+        self._playwright = None
+        self._browser = None
+        self._browser_context = None
+        self._browser_lock = asyncio.Lock()
+        self._browser_retry_at = 0
+        # 结果缓存：(url, use_js, css_selector) -> 结果及ETag/Last-Modified
+        self.cache_ttl = cache_ttl
+        self._cache = TTLCache(
+            maxsize=cache_max_bytes, ttl=cache_ttl, getsizeof=_cache_entry_size
+        )
 
     def _setup_logging(self):
         """启用日志管理"""
@@ -26,56 +130,192 @@ class UrlFetcher:
     def _clean_html(self, html):
         """HTML预处理：移除脚本、注释、样式，统一格式"""
 
-        soup = BeautifulSoup(html, "html.parser")
+        # 空白文档（或仅含注释）libxml2无法建树，返回空树与空结果，保持结果结构一致
+        if not html or html.isspace():
+            return lxml.html.Element("html"), ""
+        try:
+            try:
+                tree = lxml.html.document_fromstring(html)
+            except ValueError:
+                tree = lxml.html.document_fromstring(
+                    html.encode("utf-8"), parser=_UTF8_HTML_PARSER
+                )
+        except etree.ParserError:
+            return lxml.html.Element("html"), ""
 
-        # 移除脚本、样式、注释
-        for element in soup(["script", "style", "comment"]):
-            element.decompose()
+        # 移除脚本、样式、注释（保留其后的文本），整个遍历在libxml2中完成
+        etree.strip_elements(tree, "script", "style", etree.Comment, with_tail=False)
 
         # 获取处理后的HTML并压缩空白
-        normalized_html = re.sub(r"\s+", " ", str(soup)).strip()
+        html_str = etree.tostring(tree, method="html", encoding="unicode")
+        normalized_html = " ".join(html_str.split())
 
-        return soup, normalized_html
+        return tree, normalized_html
 
-    def _fetch_with_requests(self, url):
-        """使用requests获取静态内容"""
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-        }
+    def _check_content_length(self, size):
+        """响应体超过上限时抛出异常"""
+        if size is not None and int(size) > MAX_CONTENT_LENGTH:
+            raise ValueError(f"响应体过大（{size} 字节，上限 {MAX_CONTENT_LENGTH}）")
+
+    def _decode_body(self, body, encoding):
+        """按响应头声明的编码解码，未声明或无效时依次取<meta charset>、内容探测结果、utf-8"""
+        name = _lookup_encoding(encoding)
+        if name is None:
+            match = _META_CHARSET_RE.search(body, 0, _META_SNIFF_BYTES)
+            name = _lookup_encoding(match and match.group(1).decode("ascii"))
+        if name is None:
+            best = from_bytes(bytes(body)).best()
+            name = _lookup_encoding(best and best.encoding) or "utf-8"
+        return body.decode(_ENCODING_SUPERSETS.get(name, name), errors="replace")
 
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
+    def _fetch_with_requests(self, url, headers=None):
+        """使用requests流式获取静态内容，返回(html, 响应头)，304时html为None"""
+        with self._SESSION.get(
+            url, headers=headers, timeout=30, stream=True
+        ) as response:
+            if response.status_code == 304:
+                return None, response.headers
+            response.raise_for_status()
+            # 先按Content-Length拒绝超大页面，再在读取过程中兜底
+            self._check_content_length(response.headers.get("Content-Length"))
+            body = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                body += chunk
+                self._check_content_length(len(body))
 
-        return response.text
+            # requests对未声明charset的text/*默认ISO-8859-1，只采用响应头明确声明的编码
+            content_type = response.headers.get("Content-Type", "").lower()
+            encoding = response.encoding if "charset" in content_type else None
+            return self._decode_body(body, encoding), response.headers
 
-    def _block_unnecessary_resources(self, page):
+    async def _afetch_with_httpx(self, url, client, headers=None):
+        """使用共享的httpx.AsyncClient流式获取静态内容，返回值同_fetch_with_requests"""
+        async with client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 304:
+                return None, response.headers
+            response.raise_for_status()
+            self._check_content_length(response.headers.get("Content-Length"))
+            body = bytearray()
+            async for chunk in response.aiter_bytes(64 * 1024):
+                body += chunk
+                self._check_content_length(len(body))
+
+            return self._decode_body(body, response.charset_encoding), response.headers
+
+    async def _block_unnecessary_resources(self, context):
         # 拦截并阻断图片、视频、字体、第三方脚本
-        page.route(
+        await context.route(
             "**/*.{png,jpg,jpeg,gif,webp,mp4,woff,woff2}", lambda route: route.abort()
         )
         # 阻断常见第三方广告/统计脚本
-        page.route(
+        await context.route(
             "**/*{google-analytics,facebook,adsbygoogle}*", lambda route: route.abort()
         )
 
-    def _fetch_with_playwright(self, url):
-        """使用Playwright获取动态内容"""
+    async def create_stealth_context(self, browser):
+        """创建已应用Stealth与资源拦截的共享上下文，其中打开的页面无需重复处理"""
+        from playwright_stealth.stealth import Stealth
+
+        context = await browser.new_context(java_script_enabled=False)
         try:
-            from playwright.sync_api import sync_playwright
-            from playwright_stealth.stealth import Stealth
-
-            ws_endpoint = "ws://localhost:38291/e23e18f9f7deb171b72e32294f701368"
-            with (
-                sync_playwright() as p,
-                p.chromium.connect(ws_endpoint) as browser,
-                browser.new_context(java_script_enabled=False) as context,
-                context.new_page() as page,
-            ):
-                self._block_unnecessary_resources(page)
-                Stealth().apply_stealth_sync(page)
-                page.goto(url, wait_until="domcontentloaded")
+            await Stealth().apply_stealth_async(context)
+            await self._block_unnecessary_resources(context)
+        except Exception:
+            await context.close()
+            raise
+        return context
+
+    async def start_browser(self):
+        """启动Playwright并尝试连接共享浏览器，浏览器服务不可用时不影响应用启动"""
+        from playwright.async_api import async_playwright
+
+        self._playwright = await async_playwright().start()
+        await self._ensure_browser_context()
+
+    async def close_browser(self):
+        """关闭共享上下文、浏览器连接并停止Playwright"""
+        async with self._browser_lock:
+            await self._discard_browser()
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def _discard_browser(self):
+        """释放当前的共享浏览器连接，连接已断开时忽略关闭异常"""
+        # 先清除引用，主动关闭时不会再触发重建
+        context, browser = self._browser_context, self._browser
+        self._browser_context = self._browser = None
+        for resource in (context, browser):
+            if resource is not None:
+                try:
+                    await resource.close()
+                except Exception:
+                    pass
+
+    def _on_context_closed(self, context):
+        """共享上下文被意外关闭时清除引用，下次请求时重建"""
+        if context is self._browser_context:
+            self._browser_context = None
+
+    def _browser_ready(self):
+        return self._browser_context is not None and self._browser.is_connected()
+
+    async def _ensure_browser_context(self):
+        """返回可用的共享上下文，连接断开时重连并重建，失败返回None"""
+        if self._playwright is None:
+            return None
+        if self._browser_ready():
+            return self._browser_context
+        if time.monotonic() < self._browser_retry_at:
+            return None
+
+        async with self._browser_lock:
+            # 等锁期间可能已被其他请求重连，或刚失败进入冷却
+            if self._browser_ready():
+                return self._browser_context
+            if time.monotonic() < self._browser_retry_at:
+                return None
 
-                return page.content()
+            await self._discard_browser()
+            try:
+                self._browser = await self._playwright.chromium.connect(
+                    PLAYWRIGHT_WS_ENDPOINT, timeout=BROWSER_CONNECT_TIMEOUT
+                )
+                # Stealth 只在共享上下文上注入一次，请求仅在其中开关页面
+                self._browser_context = await self.create_stealth_context(self._browser)
+                self._browser_context.on("close", self._on_context_closed)
+            except Exception as e:
+                await self._discard_browser()
+                self._browser_retry_at = time.monotonic() + BROWSER_RETRY_INTERVAL
+                self.logger.warning(
+                    f"连接共享浏览器失败，{BROWSER_RETRY_INTERVAL}秒后重试: {e}"
+                )
+                return None
+            return self._browser_context
+
+    async def _render_page(self, context, url):
+        """在共享上下文中打开新页面渲染，结束后只关闭页面"""
+        # 上下文禁用了JavaScript，DOM在domcontentloaded时已完整，无需再等待选择器
+        async with self._page_slots, await context.new_page() as page:
+            await page.goto(url, wait_until="domcontentloaded")
+            return await page.content()
+
+    async def _afetch_with_playwright(self, url, context=None):
+        """使用Playwright获取动态内容，context为共享上下文，为空时临时连接（仅同步调用）"""
+        try:
+            if context is not None:
+                return await self._render_page(context, url)
+
+            from playwright.async_api import async_playwright
+
+            async with (
+                async_playwright() as p,
+                await p.chromium.connect(
+                    PLAYWRIGHT_WS_ENDPOINT, timeout=BROWSER_CONNECT_TIMEOUT
+                ) as browser,
+                await self.create_stealth_context(browser) as context,
+            ):
+                return await self._render_page(context, url)
         except ImportError:
             self.logger.error(
                 "请安装playwright: pip install playwright && playwright install"
@@ -85,34 +325,156 @@ class UrlFetcher:
             self.logger.error(f"Playwright获取内容失败: {e}")
             return None
 
-    def fetch_content(self, url, use_js=False, css_selector=None):
-        """获取网页内容"""
+    @asynccontextmanager
+    async def _host_slot(self, url):
+        """占用目标域名的并发名额，无人持有或等待时移除该域名的信号量"""
+        host = urlsplit(url).netloc
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = [
+                asyncio.BoundedSemaphore(self._max_per_host),
+                0,
+            ]
+        slot[1] += 1
         try:
-            if use_js:
-                raw_html = self._fetch_with_playwright(url)
-            else:
-                raw_html = self._fetch_with_requests(url)
-
-            extracted_html = None
-            if css_selector:
-                soup, normalized_html = self._clean_html(raw_html)
-                elements = soup.select(css_selector)
-                if elements:
-                    extracted_html = "\n".join(
-                        [element.get_text(strip=True) for element in elements]
-                    )
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self._host_slots[host]
+
+    def _get_cached(self, key):
+        """读取缓存，返回(缓存项, 是否可直接使用)
+
+        带ETag/Last-Modified的缓存项需要条件请求校验，其余在TTL内直接返回
+        """
+        cached = self._cache.get(key)
+        if cached is None:
+            return None, False
+        return cached, not (cached["etag"] or cached["last_modified"])
 
-                return {
-                    "raw_html": raw_html,
-                    "normalized_html": normalized_html,
-                    "extracted_html": extracted_html,
-                    "timestamp": time.time(),
-                }
+    def _conditional_headers(self, cached):
+        """根据缓存的ETag/Last-Modified构造条件请求头"""
+        headers = {}
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        return headers
+
+    def _store_cached(self, key, entry):
+        """写入（或续期）缓存项，并记录其过期时刻"""
+        entry["expires_at"] = self._cache.timer() + self.cache_ttl
+        self._cache[key] = entry
+
+    def _cache_result(self, key, result, headers=None):
+        """缓存结果及上游的校验信息，获取失败或超过缓存上限的结果不缓存"""
+        if result is None or result["raw_html"] is None:
+            return
+        headers = headers or {}
+        entry = {
+            "result": result,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+        }
+        if _cache_entry_size(entry) > self._cache.maxsize:
+            return
+        self._store_cached(key, entry)
+
+    def cache_max_age(self, url, use_js=False, css_selector=None):
+        """返回该结果在缓存中剩余的有效秒数，未缓存时为0"""
+        cached = self._cache.get((url, use_js, css_selector))
+        if cached is None:
+            return 0
+        return max(0, int(cached["expires_at"] - self._cache.timer()))
+
+    def _build_result(self, raw_html, css_selector=None):
+        """根据原始HTML组装返回结果"""
+        extracted_html = None
+        if css_selector:
+            tree, normalized_html = self._clean_html(raw_html)
+            elements = _compile_selector(css_selector)(tree)
+            if elements:
+                # 每个元素取文本内容并将连续空白压缩为单个空格，与normalized_html一致
+                extracted_html = "\n".join(
+                    " ".join(element.text_content().split()) for element in elements
+                )
 
             return {
                 "raw_html": raw_html,
+                "normalized_html": normalized_html,
+                "extracted_html": extracted_html,
                 "timestamp": time.time(),
             }
+
+        return {
+            "raw_html": raw_html,
+            "timestamp": time.time(),
+        }
+
+    def fetch_content(self, url, use_js=False, css_selector=None):
+        """获取网页内容"""
+        key = (url, use_js, css_selector)
+        cached, fresh = self._get_cached(key)
+        if fresh:
+            return cached["result"]
+
+        try:
+            headers = None
+            if use_js:
+                raw_html = asyncio.run(self._afetch_with_playwright(url))
+            else:
+                raw_html, headers = self._fetch_with_requests(
+                    url, self._conditional_headers(cached)
+                )
+                if raw_html is None and cached:
+                    # 304：内容未变化，续期并直接返回缓存
+                    self._store_cached(key, cached)
+                    return cached["result"]
+
+            result = self._build_result(raw_html, css_selector)
+            self._cache_result(key, result, headers)
+            return result
+        except Exception as e:
+            self.logger.error(f"获取 {url} 内容失败: {e}")
+            return None
+
+    async def afetch_content(self, url, client, use_js=False, css_selector=None):
+        """异步获取网页内容，client为应用共享的httpx.AsyncClient
+
+        use_js时使用共享浏览器（需先调用start_browser），不可用时直接返回失败结果
+        """
+        key = (url, use_js, css_selector)
+        cached, fresh = self._get_cached(key)
+        if fresh:
+            return cached["result"]
+
+        try:
+            headers = None
+            async with self._host_slot(url):
+                if use_js:
+                    # 共享浏览器不可用时快速失败，不再为每个请求启动新的Playwright驱动
+                    context = await self._ensure_browser_context()
+                    if context is None:
+                        self.logger.error(f"共享浏览器不可用，无法获取 {url}")
+                        raw_html = None
+                    else:
+                        raw_html = await self._afetch_with_playwright(url, context)
+                else:
+                    raw_html, headers = await self._afetch_with_httpx(
+                        url, client, self._conditional_headers(cached)
+                    )
+            if raw_html is None and cached:
+                # 304：内容未变化，续期并直接返回缓存
+                self._store_cached(key, cached)
+                return cached["result"]
+
+            # HTML解析属于CPU密集操作，放到线程中执行避免阻塞事件循环
+            result = await asyncio.to_thread(self._build_result, raw_html, css_selector)
+            self._cache_result(key, result, headers)
+            return result
         except Exception as e:
             self.logger.error(f"获取 {url} 内容失败: {e}")
             return None
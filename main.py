@@ -1,13 +1,28 @@
 # main.py
-from fastapi import FastAPI, Depends, HTTPException, Security, Path
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Security, Path, Request, Response
 from fastapi.security.api_key import APIKeyHeader
 from starlette.status import HTTP_403_FORBIDDEN
 from urllib.parse import unquote
-from app.Fetcher import UrlFetcher
+from app.UrlFetcher import UrlFetcher, build_async_client
 from app.APIKey import APIKeyManager, APIPermission
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：创建并在关闭时释放共享的 HTTP 客户端、浏览器与上下文"""
+    app.state.http = build_async_client()
+    try:
+        # 共享浏览器由 UrlFetcher 管理，浏览器服务不可用或重启时自动重连
+        await url_fetcher.start_browser()
+        yield
+    finally:
+        await url_fetcher.close_browser()
+        await app.state.http.aclose()
+
+
 # 1. 创建 FastAPI 实例
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # 定义 API Key 名称（HTTP Header 中的字段名）
 API_KEY_NAME = "X-API-Key"
@@ -18,6 +33,14 @@ api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 # 初始化 APIKeyManager
 api_key_manager = APIKeyManager(salt="test-salt-123", persist_file="./apikey_store.m5")
 
+# 全局共享 UrlFetcher，避免每次请求重建 Session 与日志器
+url_fetcher = UrlFetcher()
+
+
+async def get_fetcher() -> UrlFetcher:
+    """通过依赖注入向接口提供共享的 UrlFetcher（async 依赖无需切换线程池）"""
+    return url_fetcher
+
 
 # 验证函数
 def get_api_key(api_key_header_value: str = Security(api_key_header)):
@@ -34,13 +57,33 @@ def get_api_key(api_key_header_value: str = Security(api_key_header)):
 
 
 @app.get("/{url:path}")
-def fetch_html(
+async def fetch_html(
+    request: Request,
+    response: Response,
     url: str = Path(..., description="编码后的URL链接"),
     api_key: str = Depends(get_api_key),
+    fetcher: UrlFetcher = Depends(get_fetcher),
 ):
     print(f"Received request for URL: {url} with API Key: {api_key}")
-    # 调用 WebFetcher 类获取网页内容
-    return UrlFetcher().fetch_content(unquote(url), use_js=True)
+    # 调用 UrlFetcher 获取网页内容
+    target_url = unquote(url)
+    result = await fetcher.afetch_content(
+        target_url,
+        request.app.state.http,
+        use_js=True,
+    )
+    if result is not None and result["raw_html"] is not None:
+        # 获取失败的结果不带缓存头；同一缓存结果的时间戳不变，可直接作为 ETag
+        # max-age 取服务端缓存剩余时间，避免客户端累计持有超过一个TTL
+        max_age = fetcher.cache_max_age(target_url, use_js=True)
+        cache_headers = {
+            "Cache-Control": f"private, max-age={max_age}",
+            "ETag": f'"{result["timestamp"]}"',
+        }
+        if request.headers.get("If-None-Match") == cache_headers["ETag"]:
+            return Response(status_code=304, headers=cache_headers)
+        response.headers.update(cache_headers)
+    return result
 
 
 if __name__ == "__main__":